@@ -0,0 +1,190 @@
+# Asynchronous block writes to the capture file
+#
+# open_writer(fd, depth, sq_cpu) returns an object with
+#   register_buffers(bufs)              -- numpy arrays that writes will come from,
+#                                          False if the writer can't use that
+#   submit(buf, offset, tag, buf_index) -- queue a write of numpy array buf at offset,
+#                                          buf is (in) bufs[buf_index] if given
+#   reap(wait_nr)                       -- tags of completed writes, waits for wait_nr
+#   close()
+#   depth                               -- writes it can have in flight, 1 for pwrite()
+# Uses io_uring through liburing_writer.so if it has been built
+# ("make liburing_writer.so"), otherwise plain synchronous os.pwrite().
+#
+# Also sync_file_range(), which the os module doesn't have.
+
+import ctypes
+import os
+
+LIB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "liburing_writer.so"
+)
+
+try:
+    _lib = ctypes.CDLL(LIB_PATH, use_errno=True)
+except OSError:
+    _lib = None
+else:
+    _lib.uw_open.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_int)
+    _lib.uw_open.restype = ctypes.c_void_p
+    _lib.uw_register_buffers.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_uint,
+    )
+    _lib.uw_register_buffers.restype = ctypes.c_int
+    _lib.uw_write.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_uint,
+        ctypes.c_uint64,
+        ctypes.c_int,
+        ctypes.c_uint64,
+    )
+    _lib.uw_write.restype = ctypes.c_int
+    _lib.uw_reap.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_uint,
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.c_uint,
+    )
+    _lib.uw_reap.restype = ctypes.c_int
+    _lib.uw_close.argtypes = (ctypes.c_void_p,)
+    _lib.uw_close.restype = None
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.sync_file_range.argtypes = (
+    ctypes.c_int,
+    ctypes.c_int64,
+    ctypes.c_int64,
+    ctypes.c_uint,
+)
+_libc.sync_file_range.restype = ctypes.c_int
+
+# flags for sync_file_range(), from <fcntl.h>
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# from <linux/io_uring.h>
+IORING_SETUP_SQPOLL = 1 << 1
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+def sync_file_range(fd, offset, nbytes, flags):
+    """Start (and optionally wait for) writeback of part of a file"""
+    if _libc.sync_file_range(fd, offset, nbytes, flags) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def _check(ret):
+    if ret < 0:
+        raise OSError(-ret, os.strerror(-ret))
+    return ret
+
+
+class UringWriter:
+    """Writes queued with io_uring, up to depth of them in flight
+
+    With sqpoll, a kernel thread (on sq_cpu, if given) picks up submissions,
+    so submitting doesn't need a syscall while that thread is awake.
+    """
+
+    def __init__(self, fd, depth, sqpoll=False, sq_cpu=None):
+        self.fd = fd
+        self.depth = depth
+        self.sqpoll = sqpoll
+        flags = IORING_SETUP_SQPOLL if sqpoll else 0
+        self._ring = _lib.uw_open(depth, flags, -1 if sq_cpu is None else sq_cpu)
+        if not self._ring:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._tags = (ctypes.c_uint64 * depth)()
+        self._results = (ctypes.c_int * depth)()
+        self._nbytes = {}
+
+    def register_buffers(self, bufs):
+        iovecs = (iovec * len(bufs))(*[iovec(b.ctypes.data, b.nbytes) for b in bufs])
+        _check(_lib.uw_register_buffers(self._ring, iovecs, len(bufs)))
+        return True
+
+    def submit(self, buf, offset, tag, buf_index=None):
+        _check(
+            _lib.uw_write(
+                self._ring,
+                self.fd,
+                buf.ctypes.data,
+                buf.nbytes,
+                offset,
+                -1 if buf_index is None else buf_index,
+                tag,
+            )
+        )
+        self._nbytes[tag] = buf.nbytes
+
+    def reap(self, wait_nr=0):
+        n = _check(
+            _lib.uw_reap(self._ring, wait_nr, self._tags, self._results, self.depth)
+        )
+        done = []
+        for k in range(n):
+            tag, res = self._tags[k], self._results[k]
+            _check(res)
+            if res != self._nbytes.pop(tag):
+                raise OSError(f"short write: {res} bytes for block {tag}")
+            done.append(tag)
+        return done
+
+    def close(self):
+        if self._ring:
+            _lib.uw_close(self._ring)
+            self._ring = None
+
+
+class PwriteWriter:
+    """Same interface as UringWriter, but each write completes in submit()
+
+    so depth is always 1, there's no point queuing more before reaping.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.depth = 1
+        self._done = []
+
+    def register_buffers(self, bufs):
+        return False  # nothing to register with pwrite()
+
+    def submit(self, buf, offset, tag, buf_index=None):
+        n = os.pwrite(self.fd, buf, offset)
+        if n != buf.nbytes:
+            raise OSError(f"short write: {n} bytes for block {tag}")
+        self._done.append(tag)
+
+    def reap(self, wait_nr=0):
+        done, self._done = self._done, []
+        return done
+
+    def close(self):
+        pass
+
+
+def open_writer(fd, depth, sq_cpu=None):
+    """Best writer available: io_uring with SQPOLL, io_uring, or pwrite()"""
+    if _lib is not None:
+        for sqpoll in (True, False):
+            try:
+                return UringWriter(fd, depth, sqpoll=sqpoll, sq_cpu=sq_cpu)
+            except OSError:
+                # e.g. SQPOLL needs privileges, io_uring disabled, or (EOPNOTSUPP)
+                #   a kernel too old for SQPOLL without registered files, or
+                #   for IORING_OP_WRITE
+                pass
+    return PwriteWriter(fd)
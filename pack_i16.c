@@ -0,0 +1,44 @@
+/*
+ * AVX2 float32 -> int16 packing for receive buffers
+ *
+ * Build with "make libpack_i16.so", loaded by sample_pack.py via ctypes.
+ *
+ * Each iteration converts 16 samples: scale, clamp to the int16 range,
+ * truncate to int32 (same as numpy's astype), then pack to int16.
+ * packs_epi32 works within 128-bit lanes, so permute4x64 puts the
+ * result back in order before the store.
+ *
+ * dst may be the start of src's own memory (in-place packing): stores only
+ * ever land on floats that have already been loaded.
+ */
+
+#include <immintrin.h>
+#include <stddef.h>
+#include <stdint.h>
+
+void pack_scaled_i16(const float *src, int16_t *dst, size_t n, float scale)
+{
+    const __m256 s = _mm256_set1_ps(scale);
+    const __m256 lo_limit = _mm256_set1_ps(-32768.0f);
+    const __m256 hi_limit = _mm256_set1_ps(32767.0f);
+    size_t k = 0;
+
+    for (; k + 16 <= n; k += 16) {
+        __m256 a = _mm256_mul_ps(_mm256_loadu_ps(src + k), s);
+        __m256 b = _mm256_mul_ps(_mm256_loadu_ps(src + k + 8), s);
+        a = _mm256_min_ps(_mm256_max_ps(a, lo_limit), hi_limit);
+        b = _mm256_min_ps(_mm256_max_ps(b, lo_limit), hi_limit);
+        __m256i packed =
+            _mm256_packs_epi32(_mm256_cvttps_epi32(a), _mm256_cvttps_epi32(b));
+        packed = _mm256_permute4x64_epi64(packed, 0xD8);
+        _mm256_storeu_si256((__m256i *)(dst + k), packed);
+    }
+    for (; k < n; k++) {
+        float v = src[k] * scale;
+        if (v > 32767.0f)
+            v = 32767.0f;
+        else if (v < -32768.0f)
+            v = -32768.0f;
+        dst[k] = (int16_t)v;
+    }
+}
@@ -7,6 +7,13 @@
 #  https://kb.ettus.com/USRP_Host_Performance_Tuning_Tips_and_Tricks
 #  https://www.cyberciti.biz/faq/howto-set-real-time-scheduling-priority-process/
 #  sudo cpufreq-info -g # shows possible governors  -l shows min and max frequency 
+#
+# keep the kernel off the capture cores: recv loop on 5, writer on 4,
+#  io_uring SQPOLL thread on 3.  Add to GRUB_CMDLINE_LINUX in /etc/default/grub,
+#  then update-grub and reboot
+#    isolcpus=3,4,5 nohz_full=3,4,5 rcu_nocbs=3,4,5
+#  the writer asks for SCHED_DEADLINE, which the kernel refuses for a task
+#  pinned to isolated cores, in that case it falls back to SCHED_FIFO on core 4
 
 # set all processors for performance
 for ((i=0;i<$(nproc --all);i++)); do sudo cpufreq-set -c $i -r -g performance; done
@@ -0,0 +1,98 @@
+# float32 -> int16 packing of receive buffers
+#
+# pack_i16(src_f32, dst_i16, scale) scales, converts, and stores in one pass.
+# pack_i16_inplace(buf_f32, scale) does the same into the first half of buf_f32's
+# own memory and returns that int16 view.
+# Uses the AVX2 kernel in libpack_i16.so if it has been built
+# ("make libpack_i16.so"), otherwise falls back to a Numba kernel, and if Numba
+# isn't installed either, to plain NumPy.
+
+import ctypes
+import os
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libpack_i16.so")
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, nogil=True)
+    def pack_i16_numba(src_f32, dst_i16, scale):
+        """Scale float32 samples and store them as saturated int16 in a single pass"""
+        scale = np.float32(scale)  # keep the multiply in single precision
+        for k in prange(src_f32.size):
+            v = min(max(src_f32[k] * scale, np.float32(-32768)), np.float32(32767))
+            dst_i16[k] = np.int16(v)
+
+    @njit(fastmath=True, nogil=True)
+    def pack_i16_numba_serial(src_f32, dst_i16, scale):
+        """Same as pack_i16_numba, front to back in one thread"""
+        scale = np.float32(scale)
+        for k in range(src_f32.size):
+            v = min(max(src_f32[k] * scale, np.float32(-32768)), np.float32(32767))
+            dst_i16[k] = np.int16(v)
+
+
+# float32 scratch buffers for pack_i16_numpy, by size, so it doesn't allocate
+_scratch = {}
+
+
+def pack_i16_numpy(src_f32, dst_i16, scale):
+    """Scale float32 samples and store them as saturated int16, using NumPy ufuncs
+
+    The scale is applied while copying into a preallocated scratch buffer,
+    rather than in place in src_f32 and then again through astype's temporary.
+    """
+    tmp_f32 = _scratch.get(src_f32.size)
+    if tmp_f32 is None:
+        tmp_f32 = _scratch[src_f32.size] = np.empty(src_f32.size, dtype=np.float32)
+    np.multiply(src_f32, np.float32(scale), out=tmp_f32)
+    np.clip(tmp_f32, -32768, 32767, out=tmp_f32)
+    np.copyto(dst_i16, tmp_f32, casting="unsafe")
+
+
+try:
+    _lib = ctypes.CDLL(LIB_PATH)
+except OSError:
+    _lib = None
+else:
+    _lib.pack_scaled_i16.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_float,
+    )
+    _lib.pack_scaled_i16.restype = None
+
+
+def pack_i16_avx2(src_f32, dst_i16, scale):
+    """Scale float32 samples and store them as saturated int16 using AVX2"""
+    if src_f32.size != dst_i16.size:
+        raise ValueError(f"size mismatch: {src_f32.size} != {dst_i16.size}")
+    _lib.pack_scaled_i16(src_f32.ctypes.data, dst_i16.ctypes.data, src_f32.size, scale)
+
+
+if _lib is not None:
+    pack_i16 = _pack_i16_serial = pack_i16_avx2
+elif njit is not None:
+    pack_i16 = pack_i16_numba
+    _pack_i16_serial = pack_i16_numba_serial
+else:
+    pack_i16 = _pack_i16_serial = pack_i16_numpy
+
+
+def pack_i16_inplace(buf_f32, scale):
+    """Pack buf_f32 to int16 in the first half of its own memory, returns that view
+
+    Each int16 lands at or before the float it came from, so this is safe as
+    long as the kernel goes front to back, which rules out the parallel one.
+    """
+    dst_i16 = buf_f32.view(np.int16)[: buf_f32.size]
+    _pack_i16_serial(buf_f32, dst_i16, scale)
+    return dst_i16
@@ -0,0 +1,126 @@
+/*
+ * Minimal io_uring write queue for disk_writer.py
+ *
+ * Build with "make liburing_writer.so" (needs liburing), loaded via ctypes.
+ *
+ * The liburing prep/cqe helpers are static inlines, so they can't be called
+ * from ctypes directly; this wraps just what the writer needs.  Functions
+ * return 0 or a count on success and -errno on failure.
+ */
+
+#include <errno.h>
+#include <liburing.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/uio.h>
+
+struct uring_writer {
+    struct io_uring ring;
+};
+
+/* IORING_OP_WRITE (5.6) and IORING_OP_WRITE_FIXED are what uw_write() uses.
+ * Kernels too old to have the probe (also 5.6) don't have OP_WRITE either. */
+static int write_ops_supported(struct io_uring *ring)
+{
+    struct io_uring_probe *probe = io_uring_get_probe_ring(ring);
+    int ok;
+
+    if (!probe)
+        return 0;
+    ok = io_uring_opcode_supported(probe, IORING_OP_WRITE) &&
+         io_uring_opcode_supported(probe, IORING_OP_WRITE_FIXED);
+    io_uring_free_probe(probe);
+    return ok;
+}
+
+/* flags are IORING_SETUP_*, with IORING_SETUP_SQPOLL the kernel's
+ * submission thread is pinned to sq_cpu unless that is negative.
+ * Fails with EOPNOTSUPP if the ring couldn't do our writes: before 5.11 an
+ * SQPOLL ring only takes registered files, and every write would complete
+ * with -EBADF, so that is refused here rather than found out mid-capture. */
+struct uring_writer *uw_open(unsigned entries, unsigned flags, int sq_cpu)
+{
+    struct uring_writer *w = calloc(1, sizeof(*w));
+    struct io_uring_params p;
+    int ret;
+
+    if (!w)
+        return NULL;
+    memset(&p, 0, sizeof(p));
+    p.flags = flags;
+    if ((flags & IORING_SETUP_SQPOLL) && sq_cpu >= 0) {
+        p.flags |= IORING_SETUP_SQ_AFF;
+        p.sq_thread_cpu = sq_cpu;
+    }
+    ret = io_uring_queue_init_params(entries, &w->ring, &p);
+    if (ret < 0) {
+        free(w);
+        errno = -ret;
+        return NULL;
+    }
+    if (((flags & IORING_SETUP_SQPOLL) &&
+         !(p.features & IORING_FEAT_SQPOLL_NONFIXED)) ||
+        !write_ops_supported(&w->ring)) {
+        io_uring_queue_exit(&w->ring);
+        free(w);
+        errno = EOPNOTSUPP;
+        return NULL;
+    }
+    return w;
+}
+
+/* pin buffers once, so writes from them can skip the per-I/O mapping */
+int uw_register_buffers(struct uring_writer *w, const struct iovec *iovecs,
+                        unsigned n)
+{
+    return io_uring_register_buffers(&w->ring, iovecs, n);
+}
+
+/* queue and submit one write, tag comes back from uw_reap().  If buf_index
+ * is not negative, buf lies in that registered buffer and WRITE_FIXED is
+ * used.  With SQPOLL the submit is normally just a store, no syscall. */
+int uw_write(struct uring_writer *w, int fd, const void *buf, unsigned nbytes,
+             uint64_t offset, int buf_index, uint64_t tag)
+{
+    struct io_uring_sqe *sqe = io_uring_get_sqe(&w->ring);
+    int ret;
+
+    if (!sqe)
+        return -EBUSY;
+    if (buf_index >= 0)
+        io_uring_prep_write_fixed(sqe, fd, buf, nbytes, offset, buf_index);
+    else
+        io_uring_prep_write(sqe, fd, buf, nbytes, offset);
+    io_uring_sqe_set_data(sqe, (void *)(uintptr_t)tag);
+    ret = io_uring_submit(&w->ring);
+    return ret < 0 ? ret : 0;
+}
+
+/* wait for at least wait_nr completions, then collect up to max of them */
+int uw_reap(struct uring_writer *w, unsigned wait_nr, uint64_t *tags,
+            int *results, unsigned max)
+{
+    struct io_uring_cqe *cqe;
+    unsigned n = 0;
+    int ret;
+
+    if (wait_nr) {
+        ret = io_uring_wait_cqe_nr(&w->ring, &cqe, wait_nr);
+        if (ret < 0)
+            return ret;
+    }
+    while (n < max && io_uring_peek_cqe(&w->ring, &cqe) == 0) {
+        tags[n] = (uint64_t)(uintptr_t)io_uring_cqe_get_data(cqe);
+        results[n] = cqe->res;
+        io_uring_cqe_seen(&w->ring, cqe);
+        n++;
+    }
+    return n;
+}
+
+void uw_close(struct uring_writer *w)
+{
+    io_uring_queue_exit(&w->ring);
+    free(w);
+}
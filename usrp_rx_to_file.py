@@ -1,12 +1,21 @@
 import argparse
+import atexit
 import uhd
 import logging
+import logging.handlers
+import mmap
 import numpy as np
 import os
+import queue
+import threading
 import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 import tqdm
 
+import disk_writer
+from sample_pack import pack_i16
+
 # Author: Aaron Heller aaron.heller@sri.com 24-May-2023
 
 # References:
@@ -33,6 +42,12 @@ RX_CENTER_FREQUENCY_HZ = 1.0e9
 
 PREALLOCATE_OUTPUT_FILE = True
 
+# writeback of the memmap is started a window at a time, and the window before
+#   that one is dropped from the page cache, so the kernel writes as we go
+#   rather than stalling everything when the dirty limit is hit.  That's done
+#   in a thread of its own, sync_file_range can take tens of ms.
+WRITEBACK_WINDOW_BYTES = 64 << 20
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--rx_center_frequency",
@@ -56,6 +71,13 @@ parser.add_argument(
     help="rx duration in seconds",
 )
 parser.add_argument("--preallocate_file", "-p", action="store_true", default=False)
+parser.add_argument(
+    "--zero_fill",
+    "-z",
+    action="store_true",
+    default=False,
+    help="preallocate by writing zeros rather than with fallocate, implies -p",
+)
 args = parser.parse_args()
 
 
@@ -78,10 +100,27 @@ class LogFormatter(logging.Formatter):
         return formatted_date
 
 
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener's thread
+
+    The stock prepare() formats the message in the thread that logs it, so that
+    it can be pickled, which a queue.SimpleQueue in this process doesn't need.
+    """
+
+    def prepare(self, record):
+        return record
+
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 console = logging.StreamHandler()
-logger.addHandler(console)
+# the thread that logs (e.g. the recv loop) only puts the record on a queue,
+#   formatting and the console write happen in the listener's thread
+log_queue = queue.SimpleQueue()
+logger.addHandler(LocalQueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, console)
+log_listener.start()
+atexit.register(log_listener.stop)  # which writes out whatever is still queued
 formatter = LogFormatter(
     fmt="[%(asctime)s] [%(levelname)s] (%(threadName)-10s) %(message)s"
 )
@@ -91,50 +130,61 @@ console.setFormatter(formatter)
 #   . On the first overflow, set had_an_overflow and record the time
 #   . On the next ERROR_CODE_NONE, calculate how long its been since the recorded time, and use the
 #     tick rate to estimate the number of dropped samples. Also, reset the tracking variables.
-had_an_overflow = False
-last_overflow = uhd.types.TimeSpec(0)
-# Setup the statistic counters
-num_rx_samps = 0
-num_rx_dropped = 0
-num_rx_overruns = 0
-num_rx_seqerr = 0
-num_rx_timeouts = 0
-num_rx_late = 0
-
-
-def process_metadata(usrp, metadata):
-    global had_an_overflow, last_overflow
-    global num_rx_samps, num_rx_dropped, num_rx_overruns, num_rx_seqerr, num_rx_timeouts, num_rx_late
-
+@dataclass
+class RxStats:
+    """Overflow tracking and statistic counters for process_metadata"""
+
+    had_an_overflow: bool = False
+    # (full secs, frac secs) of the last overflow, plain numbers rather than a
+    #   TimeSpec, so there's no C++ object to construct on every overflow
+    last_overflow: tuple = (0, 0.0)
+    num_rx_samps: int = 0
+    num_rx_dropped: int = 0
+    num_rx_overruns: int = 0
+    num_rx_seqerr: int = 0
+    num_rx_timeouts: int = 0
+    num_rx_late: int = 0
+
+
+# stats is deliberately a default argument, created once, so it's a fast local
+#   lookup rather than a global
+def process_metadata(usrp, metadata, stats=RxStats()):
     rate = usrp.get_rx_rate()
     # Handle the error codes
     if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
         # Reset the overflow flag
-        if had_an_overflow:
-            had_an_overflow = False
-            num_rx_dropped_here = (metadata.time_spec - last_overflow).to_ticks(rate)
-            num_rx_dropped += num_rx_dropped_here
+        if stats.had_an_overflow:
+            stats.had_an_overflow = False
+            time_spec = metadata.time_spec
+            last_full_secs, last_frac_secs = stats.last_overflow
+            num_rx_dropped_here = round(
+                (
+                    (time_spec.get_full_secs() - last_full_secs)
+                    + (time_spec.get_frac_secs() - last_frac_secs)
+                )
+                * rate
+            )
+            stats.num_rx_dropped += num_rx_dropped_here
             if True:
-                logger.warning(f"{num_rx_dropped_here} samples dropped!")
+                logger.warning("%d samples dropped!", num_rx_dropped_here)
     elif metadata.error_code == uhd.types.RXMetadataErrorCode.overflow:
-        had_an_overflow = True
-        # Need to make sure that last_overflow is a new TimeSpec object, not
+        stats.had_an_overflow = True
+        # Need to make sure that last_overflow is a copy of the time, not
         # a reference to metadata.time_spec, or it would not be useful
         # further up.
-        last_overflow = uhd.types.TimeSpec(
-            metadata.time_spec.get_full_secs(), metadata.time_spec.get_frac_secs()
-        )
+        time_spec = metadata.time_spec
+        stats.last_overflow = (time_spec.get_full_secs(), time_spec.get_frac_secs())
         # If we had a sequence error, record it
         if metadata.out_of_sequence:
-            num_rx_seqerr += 1
+            stats.num_rx_seqerr += 1
         # Otherwise just count the overrun
         else:
-            num_rx_overruns += 1
+            stats.num_rx_overruns += 1
     elif metadata.error_code == uhd.types.RXMetadataErrorCode.late:
         logger.warning(
             "Receiver error: %s, restarting streaming...", metadata.strerror()
         )
-        num_rx_late += 1
+        stats.num_rx_late += 1
         # Radio core will be in the idle state. Issue stream command to restart streaming.
         stream_cmd.time_spec = uhd.types.TimeSpec(
             usrp.get_time_now().get_real_secs() + INIT_DELAY
@@ -143,24 +193,80 @@ def process_metadata(usrp, metadata):
         # rx_streamer.issue_stream_cmd(stream_cmd)
     elif metadata.error_code == uhd.types.RXMetadataErrorCode.timeout:
         logger.warning("Receiver error: %s, continuing...", metadata.strerror())
-        num_rx_timeouts += 1
+        stats.num_rx_timeouts += 1
     else:
         logger.error("Receiver error: %s", metadata.strerror())
         logger.error("Unexpected error on receive, continuing...")
 
 
-def preallocate_output_file(samples, len_recv_buffer):
-    logger.info(f"preallocating output file ({samples.size*samples.itemsize/1e6} MB)")
-    if samples.dtype == np.int16:
-        increment = len_recv_buffer * 2
-    else:
-        increment = len_recv_buffer
+def write_back_window(samples, fd, end, window_bytes):
+    """Start writeback of the window_bytes of samples (open as fd) ending at byte
+    offset end, and drop the window before it, which should be clean by now
+
+    MADV_DONTNEED on its own only unmaps a shared mapping's pages, it doesn't
+    write or free them, that's what sync_file_range and POSIX_FADV_DONTNEED do.
+    """
+    start = end - window_bytes
+    disk_writer.sync_file_range(
+        fd, start, window_bytes, disk_writer.SYNC_FILE_RANGE_WRITE
+    )
+    if start >= window_bytes:
+        # madvise wants page aligned addresses
+        page_start = (start - window_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+        page_end = start // mmap.PAGESIZE * mmap.PAGESIZE
+        samples._mmap.madvise(mmap.MADV_DONTNEED, page_start, page_end - page_start)
+        os.posix_fadvise(
+            fd, start - window_bytes, window_bytes, os.POSIX_FADV_DONTNEED
+        )
+
+
+def writeback_worker(samples, fd, window_bytes, window_ends):
+    """write_back_window() for each end offset put on window_ends, until None"""
+    while True:
+        end = window_ends.get()
+        if end is None:
+            break
+        write_back_window(samples, fd, end, window_bytes)
+
+
+ZERO_FILL_CHUNK_BYTES = 16 << 20
+
+
+def preallocate_output_file(filename, num_bytes, zero_fill=False):
+    """Reserve space for the output file, without writing zeros through the page cache
+
+    With zero_fill, the space is physically written with zeros, in big O_DIRECT
+    chunks, which also gives an estimate of the disk write speed.
+    """
+    logger.info(f"preallocating output file ({num_bytes/1e6} MB)")
+    if not zero_fill:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, num_bytes)
+        finally:
+            os.close(fd)
+        return
+
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o644)
+    except OSError:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    # anonymous mmap is zeroed and page aligned, as O_DIRECT wants
+    zeros = mmap.mmap(-1, ZERO_FILL_CHUNK_BYTES)
+    # round up to whole pages for O_DIRECT, then trim back to size
+    total = -(-num_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
     t0 = time.time()
-    for i in tqdm.trange(0, len(samples), increment):
-        samples[i : (i + increment)] = 0
-    os.sync()
+    try:
+        for offset in range(0, total, ZERO_FILL_CHUNK_BYTES):
+            n = min(ZERO_FILL_CHUNK_BYTES, total - offset)
+            os.pwrite(fd, memoryview(zeros)[:n], offset)
+        os.ftruncate(fd, num_bytes)
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+        zeros.close()
     write_time_seconds = time.time() - t0
-    write_speed_samples_per_second = samples.size / write_time_seconds
+    write_speed_samples_per_second = num_samps / write_time_seconds
     logger.info(
         f"Done! Write speed is {write_speed_samples_per_second/1e6:5.1f} MSa/sec;"
         f" required {sample_rate/1e6:5.1f} MSa/sec"
@@ -225,10 +331,33 @@ else:
         "test-mmap-c64.bin", dtype=np.complex64, mode="write", shape=num_samps
     )
 
+# written front to back, once
+samples._mmap.madvise(mmap.MADV_SEQUENTIAL)
+buffer_file_bytes = samples.nbytes // num_recv_buffers
+bufs_per_window = max(1, WRITEBACK_WINDOW_BYTES // buffer_file_bytes)
+# for sync_file_range and posix_fadvise, the memmap doesn't expose its fd
+samples_fd = os.open(samples.filename, os.O_RDWR)
+# the recv loop only puts the end of each window here
+writeback_window_ends = queue.SimpleQueue()
+writeback_thread = threading.Thread(
+    name="writeback",
+    target=writeback_worker,
+    args=(
+        samples,
+        samples_fd,
+        bufs_per_window * buffer_file_bytes,
+        writeback_window_ends,
+    ),
+    daemon=True,
+)
+writeback_thread.start()
+
 # Preallocate output file
 print(samples.dtype, samples.shape)
-if args.preallocate_file:
-    preallocate_output_file(samples, len_recv_buffer)
+if args.preallocate_file or args.zero_fill:
+    preallocate_output_file(
+        samples.filename, samples.size * samples.itemsize, zero_fill=args.zero_fill
+    )
 
 logger.info(
     f"Recording for {num_samps/usrp.get_rx_rate()} seconds ({num_samps} samples)"
@@ -238,41 +367,105 @@ logger.info(
     f" with {len_recv_buffer} samples per buffer"
 )
 
-# Start Stream
-stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
-stream_cmd.stream_now = True
-streamer.issue_stream_cmd(stream_cmd)
+# run pack_i16 once now, so the first buffer doesn't pay for the JIT (Numba fallback)
+if file_format == np.int16:
+    pack_i16(
+        recv_buffer[0].view(np.float32),
+        np.empty(2 * len_recv_buffer, dtype=np.int16),
+        float_to_int16_scale,
+    )
+
+
+def make_recv_loop(file_format):
+    """Returns recv_loop(num_buffers), with the per-buffer work for file_format
+    picked here, once, rather than in the loop.
+
+    What the loop uses per buffer is bound to a local of the factory first, so
+    the closures reach it through a cell rather than the module globals.
+    recv_loop returns how many buffers it got, fewer if it was interrupted.
+    """
+    recv = streamer.recv
+    buffer = recv_buffer
+    md = metadata
+    out = samples
+    buffer_bytes = buffer_file_bytes
+    trange = tqdm.trange
+    no_error = uhd.types.RXMetadataErrorCode.none
+    log_errors = logger.isEnabledFor(logging.DEBUG)  # checked once, not per buffer
+    debug = logger.debug
+    # checked every window, the writeback itself is done by writeback_worker()
+    window = bufs_per_window
+    write_back = writeback_window_ends.put
 
-try:
     if file_format == np.int16:
-        recv_buffer_int16 = np.zeros(2 * len_recv_buffer, dtype=np.int16)
-        bl = len(recv_buffer_int16)
-        for i in tqdm.trange(num_samps // len_recv_buffer):
-            streamer.recv(recv_buffer, metadata)
-            recv_buffer[:] *= float_to_int16_scale
-            recv_buffer_int16[:] = recv_buffer[0].view(np.float32).astype(np.int16)
-            samples[i * bl : (i + 1) * bl] = recv_buffer_int16
-            if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
-                pass
-            else:
-                print("!", flush=True)
+        bl = 2 * len_recv_buffer
+        src = recv_buffer[0].view(np.float32)
+        scale = float_to_int16_scale
+        pack = pack_i16
+
+        def recv_loop(num_buffers):
+            i = 0
+            try:
+                for i in trange(num_buffers):
+                    recv(buffer, md)
+                    pack(src, out[i * bl : (i + 1) * bl], scale)
+                    if (i + 1) % window == 0:
+                        write_back((i + 1) * buffer_bytes)
+                    if md.error_code == no_error:
+                        pass
+                    elif log_errors:
+                        debug("recv error: %s", md.error_code)
+            except KeyboardInterrupt:
+                return i
+            return num_buffers
+
     elif file_format == np.complex64:
-        bl = len(recv_buffer[0])
-        for i in tqdm.trange(num_samps // len_recv_buffer):
-            streamer.recv(recv_buffer, metadata)
-            samples[i * bl : (i + 1) * bl] = recv_buffer[0]
-            # process_metadata(usrp, metadata)
+        bl = len_recv_buffer
+        src = recv_buffer[0]
+
+        def recv_loop(num_buffers):
+            i = 0
+            try:
+                for i in trange(num_buffers):
+                    recv(buffer, md)
+                    out[i * bl : (i + 1) * bl] = src
+                    if (i + 1) % window == 0:
+                        write_back((i + 1) * buffer_bytes)
+                    # process_metadata(usrp, metadata)
+            except KeyboardInterrupt:
+                return i
+            return num_buffers
+
     else:
         raise TypeError(
             f"file format must be np.int16 or np.complex64, not {file_format}"
         )
 
-except KeyboardInterrupt as ki:
-    logger.info(f"Recording interrupted by user after {i * len_recv_buffer} samples.")
+    return recv_loop
+
+
+# built before the stream is started
+recv_loop = make_recv_loop(file_format)
+
+# Start Stream
+stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+stream_cmd.stream_now = True
+streamer.issue_stream_cmd(stream_cmd)
+
+try:
+    num_rx_buffers = recv_loop(num_samps // len_recv_buffer)
+    if num_rx_buffers < num_samps // len_recv_buffer:
+        logger.info(
+            "Recording interrupted by user after %d samples.",
+            num_rx_buffers * len_recv_buffer,
+        )
 
 except RuntimeError as re:
     logger.error(re)
 
+writeback_window_ends.put(None)
+writeback_thread.join()
+
 # make sure everything is written to disk
 samples.flush()
 
@@ -282,6 +475,7 @@ streamer.issue_stream_cmd(stream_cmd)
 
 # once more with feeling
 samples.flush()
+os.close(samples_fd)
 
 print(len(samples))
 print(samples[0:100])
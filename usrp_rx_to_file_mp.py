@@ -1,15 +1,26 @@
 import argparse
+import atexit
+import contextlib
+import ctypes
+import errno
+import json
 import uhd
-import itertools as it
+import math
+import mmap
 import logging
+import logging.handlers
 import numpy as np
 import os
+import platform
+import sys
 import time
 from datetime import datetime, timedelta
 import tqdm
 import queue
 import threading
-import multiprocessing as mp
+
+import disk_writer
+from sample_pack import pack_i16_inplace
 
 # Author: Aaron Heller aaron.heller@sri.com 24-May-2023
 
@@ -45,15 +56,27 @@ import multiprocessing as mp
 #
 # -------------------------------------------------------------------------------------
 
+
+# like test1() in context_manager_experiments.py, the calling thread's scheduler
+#   is put back however the with block is left.  If it can't be changed in the
+#   first place (PermissionError), there's nothing to restore.
+@contextlib.contextmanager
+def scheduler_scope(policy, priority):
+    saved_policy = os.sched_getscheduler(0)
+    saved_param = os.sched_getparam(0)
+    os.sched_setscheduler(0, policy, os.sched_param(priority))
+    try:
+        yield
+    finally:
+        os.sched_setscheduler(0, saved_policy, saved_param)
+
+
 # Can we run with real-time scheduler?
 try:
-    sched = os.sched_getscheduler(0)
-    param = os.sched_getparam(0)
-    os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(99))
+    with scheduler_scope(os.SCHED_RR, 99):
+        pass
 except PermissionError as e:
     print(e)
-finally:
-    os.sched_setscheduler(0, sched, param)
 
 
 try:
@@ -61,7 +84,8 @@ try:
 except PermissionError as e:
     print(e)
 
-if os.geteuid() != 0:
+euid = os.geteuid()
+if euid != 0:
     exit(
         "You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'. Exiting."
     )
@@ -80,6 +104,28 @@ RX_CENTER_FREQUENCY_HZ = 1.0e9
 
 PREALLOCATE_OUTPUT_FILE = False
 
+# output file is written with O_DIRECT, bypassing the page cache, in blocks of
+#   whole recv buffers, at least WRITE_BLOCK_BYTES and a multiple of the
+#   O_DIRECT alignment, with WRITES_IN_FLIGHT of them queued at a time
+DIRECT_IO_ALIGNMENT = 4096
+WRITE_BLOCK_BYTES = 1 << 20
+WRITES_IN_FLIGHT = 8
+# the ring between the recv loop and the writer holds at least this many seconds
+#   of samples, which is how long the writer can stall before blocks are dropped
+RX_QUEUE_SECONDS = 0.25
+# core for io_uring's kernel submission (SQPOLL) thread
+SQPOLL_CPU = 3
+# share of each block period reserved for the writer with SCHED_DEADLINE
+WRITER_RUNTIME_FRACTION = 0.25
+# space is reserved ahead of the writes in big steps to avoid metadata stalls
+FALLOCATE_EXTENT_BYTES = 512 << 20
+# if O_DIRECT isn't available, writeback is started every WRITEBACK_WINDOW_BYTES
+#   and the window before that one is dropped from the page cache
+WRITEBACK_WINDOW_BYTES = 64 << 20
+# with --raw_device, the samples start after a header of this many bytes,
+#   which keeps them aligned for O_DIRECT
+RAW_DEVICE_HEADER_BYTES = 4096
+
 MP = True
 
 parser = argparse.ArgumentParser()
@@ -118,7 +164,35 @@ parser.add_argument(
     default=UHD_USRP_ARGS,
     help="USRP initialization arguments",
 )
+parser.add_argument(
+    "--file_format",
+    "-t",
+    choices=("c64", "i16i"),
+    default="c64",
+    help="raw complex64 samples, or interleaved int16 I/Q packed by the writer",
+)
 parser.add_argument("--preallocate_file", "-p", action="store_true", default=False)
+parser.add_argument(
+    "--zero_fill",
+    "-z",
+    action="store_true",
+    default=False,
+    help="preallocate by writing zeros rather than with fallocate, implies -p",
+)
+parser.add_argument(
+    "--queue_blocks",
+    "-q",
+    type=int,
+    default=None,
+    help="size of the ring between recv and the writer, in write blocks"
+    f" (default {RX_QUEUE_SECONDS} seconds worth)",
+)
+parser.add_argument(
+    "--raw_device",
+    default=None,
+    help="write to this block device (e.g. a spare partition), not a file,"
+    " with a JSON header in the first 4 KB -- overwrites whatever is there!",
+)
 args = parser.parse_args()
 
 
@@ -141,10 +215,27 @@ class LogFormatter(logging.Formatter):
         return formatted_date
 
 
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener's thread
+
+    The stock prepare() formats the message in the thread that logs it, so that
+    it can be pickled, which a queue.SimpleQueue in this process doesn't need.
+    """
+
+    def prepare(self, record):
+        return record
+
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 console = logging.StreamHandler()
-logger.addHandler(console)
+# the thread that logs (e.g. the recv loop) only puts the record on a queue,
+#   formatting and the console write happen in the listener's thread
+log_queue = queue.SimpleQueue()
+logger.addHandler(LocalQueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, console)
+log_listener.start()
+atexit.register(log_listener.stop)  # which writes out whatever is still queued
 formatter = LogFormatter(
     fmt="[%(asctime)s] [%(levelname)s] (%(processName)s) (%(threadName)-10s) %(message)s"
 )
@@ -216,18 +307,44 @@ def process_metadata(usrp, metadata):
 """
 
 
-def preallocate_output_file(samples, len_recv_buffer):
-    logger.info(f"preallocating output file ({samples.size*samples.itemsize/1e6} MB)")
-    if samples.dtype == np.int16:
-        increment = len_recv_buffer * 2
-    else:
-        increment = len_recv_buffer
+ZERO_FILL_CHUNK_BYTES = 16 << 20
+
+
+def preallocate_output_file(filename, num_bytes, zero_fill=False):
+    """Reserve space for the output file, without writing zeros through the page cache
+
+    With zero_fill, the space is physically written with zeros, in big O_DIRECT
+    chunks, which also gives an estimate of the disk write speed.
+    """
+    logger.info(f"preallocating output file ({num_bytes/1e6} MB)")
+    if not zero_fill:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, num_bytes)
+        finally:
+            os.close(fd)
+        return
+
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o644)
+    except OSError:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    # anonymous mmap is zeroed and page aligned, as O_DIRECT wants
+    zeros = mmap.mmap(-1, ZERO_FILL_CHUNK_BYTES)
+    # round up to whole pages for O_DIRECT, then trim back to size
+    total = -(-num_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
     t0 = time.time()
-    for i in tqdm.trange(0, len(samples), increment):
-        samples[i : (i + increment)] = 0
-    os.sync()
+    try:
+        for offset in range(0, total, ZERO_FILL_CHUNK_BYTES):
+            n = min(ZERO_FILL_CHUNK_BYTES, total - offset)
+            os.pwrite(fd, memoryview(zeros)[:n], offset)
+        os.ftruncate(fd, num_bytes)
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+        zeros.close()
     write_time_seconds = time.time() - t0
-    write_speed_samples_per_second = samples.size / write_time_seconds
+    write_speed_samples_per_second = num_samps / write_time_seconds
     logger.info(
         f"Done! Write speed is {write_speed_samples_per_second/1e6:5.1f} MSa/sec;"
         f" required {sample_rate/1e6:5.1f} MSa/sec"
@@ -236,6 +353,23 @@ def preallocate_output_file(samples, len_recv_buffer):
         logger.error("Disk write speed not adquate for sample rate")
 
 
+def write_raw_device_header(fd, **header):
+    """Write header as JSON, NUL padded, in the first RAW_DEVICE_HEADER_BYTES of fd
+
+    so the capture can be read back without a separate metadata file.
+    """
+    text = json.dumps(dict(header, data_offset=RAW_DEVICE_HEADER_BYTES)).encode()
+    if len(text) > RAW_DEVICE_HEADER_BYTES:
+        raise ValueError(f"header is too big: {len(text)} bytes")
+    # anonymous mmap is zeroed and page aligned, as O_DIRECT wants
+    buf = mmap.mmap(-1, RAW_DEVICE_HEADER_BYTES)
+    buf[: len(text)] = text
+    try:
+        os.pwrite(fd, buf, 0)
+    finally:
+        buf.close()
+
+
 usrp = uhd.usrp.MultiUSRP(args.device_args)
 
 dev_rx_channels = usrp.get_rx_num_channels()
@@ -248,8 +382,7 @@ sample_rate = args.rx_sample_rate  # Hz
 agc = True
 gain = 50  # dB
 
-file_format = np.complex64
-# file_format = np.int16
+file_format = {"c64": np.complex64, "i16i": np.int16}[args.file_format]
 
 num_samps_min = int(sample_rate * args.duration)  # minimum number of samples received
 
@@ -275,39 +408,153 @@ num_recv_buffers = int(np.ceil(num_samps_min / len_recv_buffer))
 # rounded up to integer number of buffers
 num_samps = num_recv_buffers * len_recv_buffer
 
-recv_buffer = np.zeros((len(st_args.channels), len_recv_buffer), dtype=np.complex64)
 print("buffer size = ", len_recv_buffer)
 
 float_to_int16_scale = np.iinfo(np.int16).max
 
-# Receive Samples -- memory mapped array
+# Output file, or device
 if file_format == np.int16:
-    samples = np.memmap(
-        "test-mmap-i16i.bin", dtype=np.int16, mode="write", shape=num_samps * 2
-    )
+    output_filename = f"{args.output_path}-i16i.bin"
+    samples_shape = (num_samps * 2,)
 else:
-    samples = np.memmap(
-        f"{args.output_path}-c64.bin", dtype=np.complex64, mode="write", shape=num_samps
-    )
-
-print(samples.filename, samples.dtype, samples.shape)
-samples.flush()
+    output_filename = f"{args.output_path}-c64.bin"
+    samples_shape = (num_samps,)
+
+print(output_filename, np.dtype(file_format), samples_shape)
+
+output_bytes = samples_shape[0] * np.dtype(file_format).itemsize
+
+if args.raw_device:
+    # No filesystem, so no journal commits or extent allocation to stall a
+    #   write, and nothing to preallocate or truncate.  A block device always
+    #   does O_DIRECT.  O_EXCL on a block device fails (EBUSY) if it's mounted.
+    raw_device = True
+    output_filename = args.raw_device
+    output_fd = os.open(output_filename, os.O_WRONLY | os.O_DIRECT | os.O_EXCL)
+    direct_io = True
+    data_offset = RAW_DEVICE_HEADER_BYTES
+else:
+    raw_device = False
+    data_offset = 0
 
-# Preallocate output file
-if args.preallocate_file:
-    preallocate_output_file(samples, len_recv_buffer)
+    # Preallocate output file
+    if args.preallocate_file or args.zero_fill:
+        preallocate_output_file(output_filename, output_bytes, zero_fill=args.zero_fill)
 
+    try:
+        output_fd = os.open(
+            output_filename, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o644
+        )
+        direct_io = True
+    except OSError as e:
+        # e.g. tmpfs doesn't do O_DIRECT
+        logger.warning(f"O_DIRECT not available for {output_filename}: {e}")
+        output_fd = os.open(output_filename, os.O_WRONLY | os.O_CREAT, 0o644)
+        direct_io = False
+
+# The writer works in blocks of bufs_per_block recv buffers.  The smallest
+#   block that is a multiple of DIRECT_IO_ALIGNMENT is a power of two buffers,
+#   double it until it is at least WRITE_BLOCK_BYTES.
+#   The alignment is what's written to the file, half the ring's bytes for int16.
+buffer_bytes = len_recv_buffer * np.dtype(np.complex64).itemsize
+file_buffer_bytes = buffer_bytes // 2 if file_format == np.int16 else buffer_bytes
+bufs_per_block = DIRECT_IO_ALIGNMENT // math.gcd(file_buffer_bytes, DIRECT_IO_ALIGNMENT)
+while bufs_per_block * file_buffer_bytes < WRITE_BLOCK_BYTES:
+    bufs_per_block *= 2
+
+if raw_device:
+    # the writer writes the last, partial, block whole, so round up to blocks
+    block_bytes = bufs_per_block * file_buffer_bytes
+    needed_bytes = data_offset + -(-output_bytes // block_bytes) * block_bytes
+    device_bytes = os.lseek(output_fd, 0, os.SEEK_END)
+    if device_bytes < needed_bytes:
+        exit(
+            f"{output_filename} is too small: {device_bytes/1e9:0.3f} GB,"
+            f" need {needed_bytes/1e9:0.3f} GB"
+        )
+    # num_samples is filled in when the recording is done
+    write_raw_device_header(
+        output_fd,
+        sample_rate=usrp.get_rx_rate(),
+        center_freq=usrp.get_rx_freq(),
+        file_format=args.file_format,
+        dtype=np.dtype(file_format).name,
+        len_recv_buffer=len_recv_buffer,
+        num_samples=None,
+    )
 
-# hold 1 seconds worth of buffers -- if we fill this, something else is very wrong
-rx_queue_size = int(usrp.get_rx_rate() / len_recv_buffer)
-rx_queue = np.zeros((rx_queue_size, len_recv_buffer), dtype=np.complex64)
+# RX_QUEUE_SECONDS of blocks, not much more, so the hot buffers stay in as little
+#   memory as they can, and never fewer than the writes in flight plus the block
+#   being filled and one to spare
+if args.queue_blocks is None:
+    rx_queue_size = math.ceil(
+        RX_QUEUE_SECONDS * usrp.get_rx_rate() / (bufs_per_block * len_recv_buffer)
+    )
+else:
+    rx_queue_size = args.queue_blocks
+rx_queue_size = max(rx_queue_size, WRITES_IN_FLIGHT + 2)
+# rounded up to a power of two, so with bufs_per_block (also a power of two) the
+#   recv loop can find its slot and the block boundaries with a mask
+rx_queue_size = 1 << (rx_queue_size - 1).bit_length()
+logger.info(
+    "RX queue: %d blocks of %d buffers, %.1f MB (%.1f ms)",
+    rx_queue_size,
+    bufs_per_block,
+    rx_queue_size * bufs_per_block * buffer_bytes / 1e6,
+    1e3 * rx_queue_size * bufs_per_block * len_recv_buffer / usrp.get_rx_rate(),
+)
+# anonymous mmap is page aligned, and every block is a multiple of
+#   DIRECT_IO_ALIGNMENT bytes, so each block can be written with O_DIRECT as is
+rx_queue = np.ndarray(
+    (rx_queue_size, bufs_per_block * len_recv_buffer),
+    dtype=np.complex64,
+    buffer=mmap.mmap(-1, rx_queue_size * bufs_per_block * buffer_bytes),
+)
+# the same memory, one row per recv buffer
+rx_bufs = rx_queue.reshape(rx_queue_size * bufs_per_block, len_recv_buffer)
+# streamer.recv() writes straight into these (channels x samples) views of
+#   rx_queue, so the samples are never copied on the way to the disk
+recv_bufs = [rx_bufs[k : k + 1] for k in range(len(rx_bufs))]
+slot_mask = len(rx_bufs) - 1
+block_mask = bufs_per_block - 1
+# If the writer falls behind, the slots of the next block may still be being
+#   written, so that block goes here instead and is dropped, not put in the file.
+#   Same length as recv_bufs so the recv loop can index either the same way.
+drop_bufs = [np.zeros_like(rx_bufs[:1])] * len(recv_bufs)
+
+# rx_queue is a lock-free single-producer/single-consumer ring (MCRingBuffer).
+#   rx_head is the number of buffers the recv loop has put in rx_queue, rx_tail
+#   the number the writer has written to disk, buffer i lives in row
+#   i % len(rx_bufs).  Each counter has only one writer and sits on its own
+#   cache line, so bumping one doesn't invalidate the other.  They are only
+#   published once per block, to cut down on cache-line ping-pong between cores.
+#   There are no explicit barriers: x86 doesn't reorder stores with other stores,
+#   so the writer can't see the new head before the buffer data.
+CACHE_LINE_BYTES = 64
+# Intel's adjacent-line prefetcher fetches lines in 128 byte aligned pairs, so
+#   the counters are two lines apart, not just on different lines
+COUNTER_STRIDE_BYTES = 2 * CACHE_LINE_BYTES
+rx_ring_counters = mmap.mmap(-1, 2 * COUNTER_STRIDE_BYTES)
+rx_head = np.ndarray(1, dtype=np.uint64, buffer=rx_ring_counters, offset=0)
+rx_tail = np.ndarray(
+    1, dtype=np.uint64, buffer=rx_ring_counters, offset=COUNTER_STRIDE_BYTES
+)
+rx_head[0] = rx_tail[0] = 0
 
-rx_index_queue = mp.Queue()
+# The recv loop and the writer hand over whole blocks, never single buffers, so
+#   the buffers in a block don't need padding to whole cache lines -- but the
+#   blocks do, or the last line of the block being written out would be shared
+#   with the first line of the one recv is filling.  rx_queue is page aligned
+#   and the blocks are a multiple of DIRECT_IO_ALIGNMENT, so that holds for any
+#   len_recv_buffer.
+assert rx_queue.ctypes.data % CACHE_LINE_BYTES == 0
+assert rx_queue[0].nbytes % CACHE_LINE_BYTES == 0
 
 
 #  This needs a context object wrapper, so we can say-- with process_priority(...):
 def set_process_priority(priority, scheduler=None, affinity=None, pid=0):
-    if scheduler:
+    # SCHED_OTHER is 0, so test for None
+    if scheduler is not None:
         os.sched_setscheduler(0, scheduler, os.sched_param(priority))
     else:
         os.setpriority(os.PRIO_PROCESS, 0, priority)
@@ -319,92 +566,241 @@ def set_process_priority(priority, scheduler=None, affinity=None, pid=0):
     )
 
 
-# these two events are used to exit the sync and writer processes.
-#   could be one event, in some literature this is called a poison-pill
-#   we might want two for the write, one to signal immediate exit, another
-#   to say, empty the queue, flush, and exit.
-sync_running = mp.Event()
-writer_running = mp.Event()
+# SCHED_DEADLINE isn't in the os module, so call sched_setattr(2) directly
+#   https://www.kernel.org/doc/html/latest/scheduler/sched-deadline.html
+SCHED_DEADLINE = 6
+# the syscall number depends on the architecture, None where we don't know it
+SYS_sched_setattr = {"x86_64": 314, "aarch64": 274}.get(platform.machine())
 
 
-def sync_and_sleep(sleep_time=10):
-    logger.info("sync process starting")
-    set_process_priority(0, affinity=(3,))
+class sched_attr(ctypes.Structure):
+    _fields_ = [
+        ("size", ctypes.c_uint32),
+        ("sched_policy", ctypes.c_uint32),
+        ("sched_flags", ctypes.c_uint64),
+        ("sched_nice", ctypes.c_int32),
+        ("sched_priority", ctypes.c_uint32),
+        ("sched_runtime", ctypes.c_uint64),
+        ("sched_deadline", ctypes.c_uint64),
+        ("sched_period", ctypes.c_uint64),
+    ]
 
-    try:
-        while sync_running.is_set():
-            os.sync()
-            os.system("echo 1 > /proc/sys/vm/drop_caches")
-            time.sleep(sleep_time)
-    except KeyboardInterrupt:
-        logger.warning("caught keyboard interrupt")
 
-    logger.info("sync process exiting")
+def set_deadline_scheduler(runtime_ns, deadline_ns, period_ns, pid=0):
+    """Reserve runtime_ns of CPU within deadline_ns of the start of every period_ns"""
+    if SYS_sched_setattr is None:
+        raise OSError(
+            errno.ENOSYS, f"no sched_setattr syscall number for {platform.machine()}"
+        )
+    attr = sched_attr(
+        size=ctypes.sizeof(sched_attr),
+        sched_policy=SCHED_DEADLINE,
+        sched_runtime=int(runtime_ns),
+        sched_deadline=int(deadline_ns),
+        sched_period=int(period_ns),
+    )
+    libc = ctypes.CDLL(None, use_errno=True)
+    ret = libc.syscall(
+        ctypes.c_long(SYS_sched_setattr),
+        ctypes.c_long(pid),
+        ctypes.byref(attr),
+        ctypes.c_long(0),
+    )
+    if ret != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    logger.info(
+        f"Setting SCHED_DEADLINE runtime, deadline, period : {runtime_ns/1e3:0.1f}, {deadline_ns/1e3:0.1f}, {period_ns/1e3:0.1f} usec"
+    )
 
 
-def rx_queue_writer(samples, rx_queue, rx_index_queue, file_format, multiplier):
+# this event is used to tell the writer thread to empty the queue and exit.
+writer_running = threading.Event()
+# and this one is set by the writer if it dies, so the recording stops too
+writer_failed = threading.Event()
+
+
+def rx_queue_writer(
+    fd, rx_queue, rx_head, rx_tail, bufs_per_block, file_format, multiplier
+):
     rx_queue_writer_max_q = -1
     logger.info(
-        f"writer thread starting -> {samples.filename} {samples.size*samples.itemsize/1e9:0.3f} GB"
+        f"writer thread starting -> {output_filename} {num_samps*file_buffer_bytes/len_recv_buffer/1e9:0.3f} GB"
     )
 
-    set_process_priority(10, scheduler=os.SCHED_RR, affinity=(4,))
-
-    queue_size, buffer_size = rx_queue.shape
-    warn_size = queue_size / 2
+    writer = None
+    queue_size = len(rx_queue)
+    # blocks handed to the writer, blocks on disk, and blocks done out of order
+    submitted = completed = int(rx_tail[0]) // bufs_per_block
+    done = set()
     try:
-        while writer_running.is_set():
-            (i, ii) = rx_index_queue.get(block=True)
-            if i < 0:
-                break
-            samples[i * buffer_size : (i + 1) * buffer_size] = rx_queue[ii, :]
-            qs = rx_index_queue.qsize()
+        # Reserve a share of every block period for the writer.  The kernel
+        #   won't give SCHED_DEADLINE to a task pinned to some of the cores
+        #   (unless they're an exclusive cpuset), so if it's refused, use
+        #   SCHED_FIFO on its own core.
+        block_period_ns = 1e9 * bufs_per_block * len_recv_buffer / sample_rate
+        # a spinning thread would hold the GIL the recv loop needs, so sleep
+        idle_sleep = block_period_ns / 4e9
+        try:
+            set_deadline_scheduler(
+                WRITER_RUNTIME_FRACTION * block_period_ns,
+                block_period_ns,
+                block_period_ns,
+            )
+        except OSError as e:
+            logger.warning(f"SCHED_DEADLINE not available: {e}")
+            set_process_priority(10, scheduler=os.SCHED_FIFO, affinity=(4,))
+
+        writer = disk_writer.open_writer(fd, WRITES_IN_FLIGHT, sq_cpu=SQPOLL_CPU)
+        # 1 for the pwrite() fallback, whose writes are done before submit()
+        #   returns, so rx_tail moves every block, not every WRITES_IN_FLIGHT
+        in_flight = writer.depth
+
+        # register the blocks once, so the kernel doesn't map them on every write
+        try:
+            fixed_buffers = writer.register_buffers(
+                [rx_queue[k] for k in range(queue_size)]
+            )
+        except OSError as e:
+            logger.warning(f"could not register rx_queue with io_uring: {e}")
+            fixed_buffers = False
+        logger.info(
+            f"writing with {type(writer).__name__}"
+            f" sqpoll={getattr(writer, 'sqpoll', False)}"
+            f" fixed_buffers={fixed_buffers}"
+        )
+
+        # The recv loop only receives, the int16 conversion is done here, where
+        #   there's CPU to spare while waiting on the disk.  Each block is packed
+        #   in place, into the first half of its slot, so it's still in the
+        #   registered buffer and can go out with one WRITE_FIXED.
+        #   What's done to a block before it's written is picked here, once, so
+        #   the loop below doesn't look at file_format for every block.
+        block_bytes = bufs_per_block * file_buffer_bytes
+        if file_format == np.int16:
+            slots = [rx_queue[k].view(np.float32) for k in range(queue_size)]
+
+            def prepare_block(slot):
+                return pack_i16_inplace(slots[slot], multiplier)
+
+            pack_i16_inplace(
+                np.zeros(2 * len_recv_buffer, dtype=np.float32), multiplier
+            )
+        else:
+            # written as received
+            prepare_block = [rx_queue[k] for k in range(queue_size)].__getitem__
+        warn_size = queue_size / 2
+        # bytes reserved with fallocate, None to not (a device has no space)
+        allocated = None if raw_device else 0
+        synced = 0  # bytes handed to writeback
+        # where the window before that started, windows end on block boundaries
+        #   so they're only roughly WRITEBACK_WINDOW_BYTES
+        previous_synced = None
+        while True:
+            # read the flag before head, so once it's clear, head is final
+            running = writer_running.is_set()
+            head = int(rx_head[0])
+            # only whole blocks while running, then the last partial one
+            if running:
+                head_blocks = head // bufs_per_block
+            else:
+                head_blocks = -(-head // bufs_per_block)
+            if submitted == head_blocks and completed == submitted:
+                if not running:
+                    break
+                time.sleep(idle_sleep)
+                continue
+            qs = head_blocks - completed
             if qs > rx_queue_writer_max_q:
                 rx_queue_writer_max_q = qs
-            if qs > warn_size and qs % 1000 == 0:
-                logger.warning(f"RX writer queue is big: {qs}")
-            if False and i % 500_000 == 0:
-                samples.flush()
-    except KeyboardInterrupt:
-        logger.warning("Caught keyboard interrupt")
-        pass
-
+                if qs > warn_size:
+                    logger.warning(f"RX writer queue is big: {qs}")
+            while submitted < head_blocks and submitted - completed < in_flight:
+                offset = data_offset + submitted * block_bytes
+                if allocated is not None and offset + block_bytes > allocated:
+                    try:
+                        os.posix_fallocate(fd, allocated, FALLOCATE_EXTENT_BYTES)
+                        allocated += FALLOCATE_EXTENT_BYTES
+                    except OSError as e:
+                        logger.warning(f"fallocate failed, not reserving space: {e}")
+                        allocated = None
+                slot = submitted % queue_size
+                writer.submit(
+                    prepare_block(slot),
+                    offset,
+                    submitted,
+                    buf_index=slot if fixed_buffers else None,
+                )
+                submitted += 1
+            # block for a completion only if there's nothing else to do
+            wait = submitted == head_blocks or submitted - completed == in_flight
+            reaped = writer.reap(1 if wait else 0)
+            if reaped:
+                done.update(reaped)
+                while completed in done:
+                    done.remove(completed)
+                    completed += 1
+                rx_tail[0] = min(completed * bufs_per_block, head)
+            written = completed * block_bytes
+            if not direct_io and written - synced >= WRITEBACK_WINDOW_BYTES:
+                # start writeback of this window, the previous one should be
+                #   clean by now so its pages can go
+                disk_writer.sync_file_range(
+                    fd, synced, written - synced, disk_writer.SYNC_FILE_RANGE_WRITE
+                )
+                if previous_synced is not None:
+                    os.posix_fadvise(
+                        fd,
+                        previous_synced,
+                        synced - previous_synced,
+                        os.POSIX_FADV_DONTNEED,
+                    )
+                previous_synced = synced
+                synced = written
+    except Exception:
+        # anything from the disk (EIO, ENOSPC, a short write), or from setting
+        #   up (a scheduler or core we can't have), ends up here
+        logger.exception("writer failed, stopping the recording")
+        writer_failed.set()
+    finally:
+        if writer is not None:
+            writer.close()
     logger.info(
-        f"writer thread stopping, queue_size = {rx_index_queue.qsize()} max = {rx_queue_writer_max_q}/{queue_size}"
+        f"writer thread stopping, queue_size = {-(-int(rx_head[0]) // bufs_per_block) - completed} max = {rx_queue_writer_max_q}/{queue_size}"
     )
-    samples.flush()
 
 
-writer_thread = mp.Process(
+# The writer is a thread, so the ring is just memory, nothing is pickled or
+#   piped.  streamer.recv() and the write/reap calls (ctypes) release the GIL,
+#   and the interval is shortened so the recv loop never waits long for it.
+sys.setswitchinterval(1e-4)
+writer_thread = threading.Thread(
     name="writer",
     target=rx_queue_writer,
-    args=(samples, rx_queue, rx_index_queue, file_format, float_to_int16_scale),
+    args=(
+        output_fd,
+        rx_queue,
+        rx_head,
+        rx_tail,
+        bufs_per_block,
+        file_format,
+        float_to_int16_scale,
+    ),
 )
 
-sync_tread = mp.Process(name="sync", target=sync_and_sleep, args=(4,))
-
-
-# if file_format == np.int16:
-#         recv_buffer_int16 = np.zeros(2 * len_recv_buffer, dtype=np.int16)
-#         bl = len(recv_buffer_int16)
-#         for i in tqdm.trange(num_samps // len_recv_buffer):
-#             streamer.recv(recv_buffer, metadata)
-#             recv_buffer[:] *= float_to_int16_scale
-#             recv_buffer_int16[:] = recv_buffer[0].view(np.float32).astype(np.int16)
-#             samples[i * bl : (i + 1) * bl] = recv_buffer_int16
-#             if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
-#                 pass
-#             else:
-#                 print("!", flush=True)
 
 try:
     i = 0  # so exception doesn't error
-    bl = len(recv_buffer[0])
-    sync_running.set()  # this should be set by the sync process, not here
-    sync_tread.start()
-    writer_running.set()  # this should be set by the writer process, not here
+    # where the recv loop is putting the current block, and how many buffers it
+    #   has dropped, buffer i goes in the ring as buffer i - dropped
+    bufs = recv_bufs
+    dropped = 0
+    # each run of dropped blocks, as [buffers in the file before it, buffers]
+    drops = []
+    writer_running.set()  # this should be set by the writer thread, not here
     writer_thread.start()
-    time.sleep(2)  # this should be a wait on the sync and writer events
+    time.sleep(2)  # this should be a wait on the writer event
     logger.info(
         f"Recording for {num_samps/usrp.get_rx_rate()} seconds ({num_samps} samples)"
         f" at {usrp.get_rx_rate()/1e6} MSa/s"
@@ -413,63 +809,139 @@ try:
         f" with {len_recv_buffer} samples per buffer"
     )
 
-    os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(99))
-    os.sched_setaffinity(0, (5,))
-    logger.info(
-        f"Raising process to real-time: {os.sched_getscheduler(0)}, {os.getpriority(os.PRIO_PROCESS, 0)}"
-    )
-
-    # define the iterator here because we want to minimize the time from when we start the stream to when we read the first buffer
-    rx_iter = zip(
-        it.cycle(range(rx_queue_size)), tqdm.trange(num_samps // len_recv_buffer)
-    )
+    # FIFO, not RR, so the recv loop is never timesliced against another RT task.
+    #   Back to the old scheduler as soon as the loop is left, however that is.
+    with scheduler_scope(os.SCHED_FIFO, 99):
+        os.sched_setaffinity(0, (5,))
+        logger.info(
+            f"Raising process to real-time: {os.sched_getscheduler(0)}, {os.getpriority(os.PRIO_PROCESS, 0)}"
+        )
 
-    # Start Stream
-    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
-    stream_cmd.stream_now = True
-    streamer.issue_stream_cmd(stream_cmd)
-
-    for ii, i in rx_iter:
-        streamer.recv(recv_buffer, metadata)
-        rx_queue[ii, :] = recv_buffer[0, :]
-        rx_index_queue.put((i, ii))
-        # samples[i * bl : (i + 1) * bl] = recv_buffer[0]
-        # process_metadata(usrp, metadata)
-        if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
-            pass
-        else:
-            print("!", flush=True)
+        # set up the progress bar here because we want to minimize the time from when we start the stream to when we read the first buffer
+        num_buffers = num_samps // len_recv_buffer
+        progress = tqdm.tqdm(total=num_buffers)
+
+        # Start Stream
+        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+        stream_cmd.stream_now = True
+        streamer.issue_stream_cmd(stream_cmd)
+
+        # checked once, rather than formatting a message per bad buffer
+        log_recv_errors = logger.isEnabledFor(logging.DEBUG)
+
+        # plain counter, no iterators; everything but recv happens once per block
+        for i in range(num_buffers):
+            streamer.recv(bufs[(i - dropped) & slot_mask], metadata)
+            if (i & block_mask) == block_mask:
+                if bufs is recv_bufs:
+                    rx_head[0] = i + 1 - dropped
+                else:
+                    dropped += bufs_per_block
+                    drops[-1][1] += bufs_per_block
+                if writer_failed.is_set():
+                    raise RuntimeError("writer thread failed")
+                # the next block's slots have to be on disk before recv can use
+                #   them, checked before, not after, they are overwritten
+                free = int(rx_tail[0]) + len(rx_bufs) - (i + 1 - dropped)
+                if free >= bufs_per_block:
+                    if bufs is not recv_bufs:
+                        logger.error(
+                            "RX queue has room again, %d samples were dropped",
+                            drops[-1][1] * len_recv_buffer,
+                        )
+                    bufs = recv_bufs
+                elif bufs is recv_bufs:
+                    bufs = drop_bufs
+                    drops.append([i + 1 - dropped, 0])
+                    logger.error(
+                        "RX queue full, writer is too slow, dropping blocks"
+                        " from sample %d of the file",
+                        (i + 1 - dropped) * len_recv_buffer,
+                    )
+                progress.update(bufs_per_block)
+            # process_metadata(usrp, metadata)
+            if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
+                pass
+            elif log_recv_errors:
+                logger.debug("recv error: %s", metadata.error_code)
+        num_rx_buffers = i + 1
+        progress.update(num_rx_buffers - progress.n)
+        progress.close()
 
 except KeyboardInterrupt as ki:
     logger.warning(
         f"Recording interrupted by user after {i * len_recv_buffer/usrp.get_rx_rate():0.3f} seconds ({i * len_recv_buffer} samples)."
     )
-    writer_running.clear()
-    sync_running.clear()
+    num_rx_buffers = i
 
 except RuntimeError as re:
     logger.error(re)
-    writer_running.clear()
-    sync_running.clear()
+    num_rx_buffers = i
 
 
 # Stop Stream
 stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
 streamer.issue_stream_cmd(stream_cmd)
 
-set_process_priority(0, scheduler=os.SCHED_OTHER)
+# dropped blocks aren't in the file, nor is the part of one being dropped
+if bufs is not recv_bufs:
+    partial = (num_rx_buffers - dropped) & block_mask
+    dropped += partial
+    drops[-1][1] += partial
+num_rx_buffers -= dropped
+if dropped:
+    logger.error(
+        f"{dropped // bufs_per_block} blocks ({dropped * len_recv_buffer} samples)"
+        f" were dropped because the writer fell behind, in {len(drops)} gaps"
+    )
 
 # make sure everything is written to disk
-rx_index_queue.put((-1, -1))  # stop writer and let it finish
+rx_head[0] = num_rx_buffers  # publish the last partial batch
+writer_running.clear()  # stop writer and let it empty the queue
 writer_thread.join()
-samples.flush()
 
-sync_running.clear()
-sync_tread.join()
+if writer_failed.is_set():
+    # keep only what made it to disk, in order, not a file with holes
+    num_rx_buffers = min(num_rx_buffers, int(rx_tail[0]))
+    logger.error(
+        f"only the first {num_rx_buffers * len_recv_buffer} samples were written"
+    )
 
-# once more with feeling
-samples.flush()
-os.sync()
+if raw_device:
+    write_raw_device_header(
+        output_fd,
+        sample_rate=usrp.get_rx_rate(),
+        center_freq=usrp.get_rx_freq(),
+        file_format=args.file_format,
+        dtype=np.dtype(file_format).name,
+        len_recv_buffer=len_recv_buffer,
+        num_samples=num_rx_buffers * len_recv_buffer,
+    )
+else:
+    # the last block was written whole, and fallocate reserves past the end
+    os.ftruncate(output_fd, num_rx_buffers * file_buffer_bytes)
+os.fdatasync(output_fd)
+os.close(output_fd)
+
+# The gaps aren't in the file, the samples either side are just next to each
+#   other, so say where they are, in samples, to line the file up with time.
+if drops:
+    drops_filename = f"{args.output_path}-dropped.json"
+    with open(drops_filename, "w") as f:
+        json.dump(
+            dict(
+                output=output_filename,
+                sample_rate=usrp.get_rx_rate(),
+                # [sample of the file the gap comes before, samples dropped]
+                dropped=[
+                    [n * len_recv_buffer, d * len_recv_buffer]
+                    for n, d in drops
+                    if n <= num_rx_buffers
+                ],
+            ),
+            f,
+        )
+    logger.error(f"where samples were dropped is in {drops_filename}")
 
 # print(len(samples))
 # print(samples[0:100])